@@ -4,16 +4,42 @@
 智能仓储巡检计划生成器（中文出入口支持）
 - 起点: "入口"
 - 终点: "出口"
-- 中间点由 Qwen3-Max 决策 + 最短路径排序
+- 中间点由 Qwen3-Max 决策 + 最短路径排序（贪心 + 2-opt）
 """
 
 import os
+import sys
 import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import pickle
+import mmap
+import tempfile
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import yaml
 import re
-import math
-import dashscope
-from dashscope import Generation
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from yaml import CSafeLoader as _YamlLoader  # libyaml C 实现
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    import orjson  # SIMD 加速的 JSON 解析/序列化
+except ImportError:  # orjson 可选：缺失时使用标准库 json
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:  # numba 可选：缺失时使用 NumPy/纯 Python 实现
+    njit = None
 
 # ======================
 # 配置文件路径
@@ -23,19 +49,85 @@ PATROL_POINTS_YAML = "patrol_points_arm.yaml"
 INSPECTION_LOG_JSON = "inspection_log_20260213.json"
 OUTPUT_PLAN_JSON = "today_inspection_plan.json"
 
-# 初始化 DashScope API
-dashscope.base_http_api_url = 'https://dashscope.aliyuncs.com/api/v1'
-dashscope.api_key = os.getenv("DASHSCOPE_API_KEY")
+# LLM 输出长度预算：decision_reason 等固定部分 + 每个候选任务点一条计划项
+# （每项约 15–20 token，留有余量）
+PLAN_BASE_TOKENS = 256
+PLAN_TOKENS_PER_POINT = 32
+
+# LLM 响应缓存（相同提示词在有效期内直接复用决策）
+LLM_CACHE_DB = os.path.expanduser("~/.cache/inspection_plan.db")
+LLM_CACHE_TTL = 1800  # 秒
+
+# YAML 解析结果缓存目录（按源文件 mtime+size 失效）
+YAML_CACHE_DIR = os.path.expanduser("~/.cache/inspection_plan_yaml")
+
+# LLM 输出中的 Markdown 代码块标记（```json / ```）
+_FENCE_RE = re.compile(r"```(?:json)?\s*", re.IGNORECASE)
+
+# DashScope 文本生成接口（直接 HTTP 调用，复用连接池中的 TLS 连接）
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/api/v1"
+GENERATION_URL = DASHSCOPE_BASE_URL + "/services/aigc/text-generation/generation"
+
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
 
 # ======================
 # 工具函数
 # ======================
 
+def json_loads(data):
+    """解析 JSON（str / bytes / memoryview），优先使用 orjson；解析失败统一抛出 json.JSONDecodeError"""
+    if orjson is not None:
+        return orjson.loads(data)  # orjson.JSONDecodeError 是 json.JSONDecodeError 的子类
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=False):
+    """序列化为 UTF-8 JSON 字符串（不转义中文），优先使用 orjson"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+def load_yaml(path):
+    """解析 YAML 文件；解析结果按文件 mtime+size 缓存为 pickle，源文件未变时直接复用"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    name = hashlib.blake2b(os.path.abspath(path).encode("utf-8"), digest_size=16).hexdigest()
+    cache_path = os.path.join(YAML_CACHE_DIR, name + ".pkl")
+
+    try:
+        with open(cache_path, "rb") as f:
+            cached_stamp, data = pickle.load(f)
+        if cached_stamp == stamp:
+            return data
+    except Exception:  # 缓存缺失或损坏一律视为未命中，重新解析
+        pass
+
+    with open(path, "r", encoding="utf-8") as f:
+        data = yaml.load(f, Loader=_YamlLoader)
+
+    # 先写临时文件再原子替换，避免并发运行或中途被杀时留下半截缓存
+    tmp_path = None
+    try:
+        os.makedirs(YAML_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=YAML_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((stamp, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return data
+
+
 def load_map_metadata():
     """加载地图元数据（用于验证，路径规划使用世界坐标）"""
-    with open(MAP_YAML, 'r', encoding='utf-8') as f:
-        meta = yaml.safe_load(f)
+    meta = load_yaml(MAP_YAML)
     origin = meta.get("origin", [0, 0, 0])
     return {
         "resolution": float(meta["resolution"]),
@@ -44,80 +136,213 @@ def load_map_metadata():
     }
 
 
-def euclidean_distance(p1, p2):
-    """计算两点间欧氏距离（单位：米）"""
-    return math.hypot(p1[0] - p2[0], p1[1] - p2[1])
+def pairwise_sq_distance_matrix(xy):
+    """计算 (N, 2) 坐标数组的两两平方距离矩阵 (N, N)，用于只比较远近的场景（免开方）"""
+    P = np.asarray(xy, dtype=np.float64)
+    diff = P[:, None, :] - P[None, :, :]
+    return (diff * diff).sum(axis=-1)
+
+
+def pairwise_distance_matrix(xy):
+    """计算 (N, 2) 坐标数组的两两欧氏距离矩阵 (N, N)（单位：米）"""
+    return np.sqrt(pairwise_sq_distance_matrix(xy))
+
+
+def _nn_order_numpy(D):
+    """贪心最近邻（NumPy 版）：D 为距离或平方距离矩阵，下标 0 为起点，n-1 为终点，返回完整访问顺序"""
+    n = D.shape[0]
+    alive = np.zeros(n, dtype=bool)
+    alive[1:n - 1] = True
+    route = np.empty(n, dtype=np.int64)
+    route[0], route[n - 1] = 0, n - 1
+    for k in range(1, n - 1):
+        i = int(np.where(alive, D[route[k - 1]], np.inf).argmin())
+        route[k] = i
+        alive[i] = False
+    return route
+
+
+def _nn_order_loop(D):
+    """贪心最近邻（标量循环版，供 numba 编译）：约定同 _nn_order_numpy"""
+    n = D.shape[0]
+    alive = np.ones(n, dtype=np.bool_)
+    alive[0] = False
+    alive[n - 1] = False
+    route = np.empty(n, dtype=np.int64)
+    route[0] = 0
+    route[n - 1] = n - 1
+    cur = 0
+    for k in range(1, n - 1):
+        best = -1
+        bd = 1e300
+        for i in range(1, n - 1):
+            if alive[i] and D[cur, i] < bd:
+                bd = D[cur, i]
+                best = i
+        route[k] = best
+        alive[best] = False
+        cur = best
+    return route
+
+
+def _two_opt_loop(route, D):
+    """2-opt 局部优化：原地反转区间消除交叉边，首尾（入口/出口）保持不动"""
+    n = route.shape[0]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 2):
+            for j in range(i + 1, n - 1):
+                a, b, c, d = route[i - 1], route[i], route[j], route[j + 1]
+                # 容差避免浮点误差导致来回反转
+                if D[a, b] + D[c, d] > D[a, c] + D[b, d] + 1e-9:
+                    lo, hi = i, j
+                    while lo < hi:
+                        route[lo], route[hi] = route[hi], route[lo]
+                        lo += 1
+                        hi -= 1
+                    improved = True
+    return route
+
+
+if njit is not None:
+    _nn_order = njit(cache=True, fastmath=True)(_nn_order_loop)
+    _two_opt = njit(cache=True)(_two_opt_loop)
+else:
+    _nn_order = _nn_order_numpy
+    _two_opt = _two_opt_loop
+
+
+def warm_up_tsp():
+    """预先触发路径规划内核的 numba 编译（可在等待 LLM 响应时后台执行）"""
+    D = pairwise_distance_matrix(np.zeros((3, 2)))
+    _two_opt(_nn_order(D), D)
+
+
+def build_point_table(point_dict):
+    """
+    将巡检点整理为列式数组（SoA），供路径规划按下标访问：
+    names 名称列表、xy (N, 2) 平面坐标、z 高度、tasks 机械臂任务类型、index 名称→下标
+    """
+    names = list(point_dict)
+    return {
+        "names": names,
+        "xy": np.array([[point_dict[n]["x"], point_dict[n]["y"]] for n in names], dtype=np.float64),
+        "z": np.array([point_dict[n]["z"] for n in names], dtype=np.float64),
+        "tasks": np.array([point_dict[n]["arm_task"] for n in names], dtype=np.int8),
+        "index": {n: i for i, n in enumerate(names)}
+    }
 
 
-def solve_tsp_with_fixed_ends(middle_waypoints, point_dict):
+def solve_tsp_with_fixed_ends(middle_waypoints, table):
     """
     生成完整路径: "入口" → [中间任务点] → "出口"
+    middle_waypoints 为 enrich_with_coordinates 的输出（点下标 + 动作）
+    返回 (有序航点列表, 总路径长度米)
     """
-    # === 获取起点 "入口" ===
-    if "入口" not in point_dict:
+    # === 获取起点 "入口" 与终点 "出口" ===
+    if "入口" not in table["index"]:
         raise ValueError("❌ patrol_points_arm.yaml 中缺少 '入口' 点")
-    ent = point_dict["入口"]
-    start_point = {
-        "point_name": "入口",
-        "position": [round(ent["x"], 3), round(ent["y"], 3), round(ent["z"], 3)],
-        "action": "arrive",
-        "arm_task_type": 0
-    }
-
-    # === 获取终点 "出口" ===
-    if "出口" not in point_dict:
+    if "出口" not in table["index"]:
         raise ValueError("❌ patrol_points_arm.yaml 中缺少 '出口' 点")
-    ex = point_dict["出口"]
-    end_point = {
-        "point_name": "出口",
-        "position": [round(ex["x"], 3), round(ex["y"], 3), round(ex["z"], 3)],
-        "action": "arrive",
-        "arm_task_type": 0
-    }
-
-    # === 若无中间点，直接返回 [入口, 出口] ===
-    if not middle_waypoints:
-        return [start_point, end_point]
 
-    # === 贪心排序中间点：从 "入口" 开始，依次选最近 ===
-    ordered = []
-    unvisited = middle_waypoints[:]
-    current_pos = start_point["position"][:2]
+    # === 距离矩阵：下标 0 为 "入口"，1..N 为中间点，N+1 为 "出口" ===
+    stops = np.array(
+        [table["index"]["入口"]] + [w["index"] for w in middle_waypoints] + [table["index"]["出口"]],
+        dtype=np.int64
+    )
+    actions = ["arrive"] + [w["action"] for w in middle_waypoints] + ["arrive"]
+    # 贪心只比较远近，用平方距离；2-opt 与总长度需要真实距离，整体开方一次
+    D2 = pairwise_sq_distance_matrix(table["xy"][stops])
+    D = np.sqrt(D2)
+
+    # === 贪心排序中间点：从 "入口" 开始，依次选最近；再用 2-opt 优化 ===
+    route = _two_opt(_nn_order(D2), D)
+    total_dist = float(D[route[:-1], route[1:]].sum())
+
+    # === 仅在输出时统一取整并转为 Python 列表 ===
+    pts = stops[route]
+    positions = np.round(np.column_stack((table["xy"][pts], table["z"][pts])), 3).tolist()
+    arm_tasks = table["tasks"][pts].tolist()
+    arm_tasks[0] = arm_tasks[-1] = 0  # 出入口仅通行
+    ordered = [
+        {
+            "point_name": table["names"][p],
+            "position": positions[k],
+            "action": actions[r],
+            "arm_task_type": arm_tasks[k]
+        }
+        for k, (p, r) in enumerate(zip(pts.tolist(), route.tolist()))
+    ]
+    return ordered, total_dist
+
+
+def new_json_scan_state():
+    """括号扫描的初始状态：首个 '{' 下标、嵌套深度、是否在字符串内、是否处于转义"""
+    return {"start": -1, "depth": 0, "in_str": False, "esc": False}
+
+
+def scan_json_object(text: str, pos: int, state):
+    """
+    从 pos 起推进括号扫描（跳过字符串内的括号与转义），状态保存在 state 中，
+    文本追加后可从上次扫描结束处继续。找到与首个 '{' 配对的 '}' 时返回其结束下标+1，否则返回 None
+    """
+    if state["start"] < 0:
+        i = text.find("{", pos)
+        if i < 0:
+            return None
+        state["start"] = pos = i
+    depth, in_str, esc = state["depth"], state["in_str"], state["esc"]
+    for j in range(pos, len(text)):
+        c = text[j]
+        if esc:
+            esc = False
+        elif c == "\\":
+            esc = in_str
+        elif c == '"':
+            in_str = not in_str
+        elif in_str:
+            continue
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                state.update(depth=0, in_str=False, esc=False)
+                return j + 1
+    state.update(depth=depth, in_str=in_str, esc=esc)
+    return None
 
-    while unvisited:
-        nearest = min(unvisited, key=lambda w: euclidean_distance(current_pos, w["position"][:2]))
-        ordered.append(nearest)
-        current_pos = nearest["position"][:2]
-        unvisited.remove(nearest)
 
-    return [start_point] + ordered + [end_point]
+def find_json_object(text: str, start: int = 0):
+    """
+    单遍括号扫描：从 start 起定位第一个 '{' 及与之配对的 '}'（跳过字符串内的括号与转义）。
+    返回 (起始下标, 结束下标+1)；未找到完整对象返回 None
+    """
+    state = new_json_scan_state()
+    end = scan_json_object(text, start, state)
+    return None if end is None else (state["start"], end)
 
 
 def extract_json_from_text(text: str):
     """从 LLM 输出中提取合法 JSON"""
     text = text.strip()
     try:
-        json.loads(text)
+        json_loads(text)
         return text
     except json.JSONDecodeError:
         pass
 
-    match = re.search(r"```(?:json)?\s*({.*?})\s*```", text, re.DOTALL | re.IGNORECASE)
-    if match:
-        try:
-            json.loads(match.group(1))
-            return match.group(1)
-        except json.JSONDecodeError:
-            pass
-
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if match:
+    # 候选对象解析失败（如前面混有 {x} 之类的文字）时，从下一个 '{' 继续扫描
+    text = _FENCE_RE.sub("", text)
+    span = find_json_object(text)
+    while span is not None:
+        candidate = text[span[0]:span[1]]
         try:
-            json.loads(match.group(0))
-            return match.group(0)
+            json_loads(candidate)
+            return candidate
         except json.JSONDecodeError:
-            pass
-
+            span = find_json_object(text, span[0] + 1)
     return None
 
 
@@ -127,12 +352,14 @@ def extract_json_from_text(text: str):
 
 def load_data():
     """加载巡检点和历史日志"""
-    with open(PATROL_POINTS_YAML, "r", encoding="utf-8") as f:
-        points = yaml.safe_load(f)["patrol_points_arm"]
+    points = load_yaml(PATROL_POINTS_YAML)["patrol_points_arm"]
     point_dict = {p["name"]: p for p in points}
 
-    with open(INSPECTION_LOG_JSON, "r", encoding="utf-8") as f:
-        log = json.load(f)
+    # 内存映射日志文件，orjson 直接解析页缓存中的字节，无需先拷贝读入
+    with open(INSPECTION_LOG_JSON, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as view:
+        log = json_loads(view)
 
     return point_dict, log
 
@@ -141,8 +368,40 @@ def load_data():
 # LLM 交互
 # ======================
 
+# arm_task 取值 → 含义（下标即任务类型；附对应的 LLM 动作名）
+_TASK_DESC = ("无任务", "task_1扫描", "task_2抓取")
+
+# LLM 动作 → 机器人执行动作（驻留字符串，下游按键比较可走指针相等）
+_ACTION_MAP = {
+    sys.intern(k): sys.intern(v) for k, v in {
+        "arrive": "arrive",
+        "task_1": "execute_arm_task_1",
+        "task_2": "execute_arm_task_2"
+    }.items()
+}
+
+# 固定的系统提示（角色、规则、输出格式、示例）放在最前，
+# 每次调用前缀完全一致，便于服务端复用前缀缓存
+SYSTEM_PREFIX = """仓储巡检调度：根据地图与上次巡检日志生成本次巡检计划。
+地图每行: 名称,x,y,arm_task（""" + " ".join(f"{i}={d}" for i, d in enumerate(_TASK_DESC)) + """）；日志每行: 名称,状态
+
+【决策规则】
+1. 必须重试上次失败的点（特别是状态含 'failed' 的）。
+2. 上次成功的点可跳过。
+3. 不要选择 '入口' 或 '出口'（它们仅用于路径起终点）。
+4. 输出严格 JSON：
+   - "decision_reason": 字符串（简要说明）
+   - "inspection_plan": 数组，每项含 "point_name" 和 "action"（"arrive" / "task_1" / "task_2"）
+
+【重要】只输出可被 json.loads() 直接解析的 JSON，不要解释、Markdown 或 ```。
+
+示例输出：
+{"decision_reason": "货架B区上次抓取失败，需重试。","inspection_plan": [{"point_name": "货架B区", "action": "task_2"}]}
+"""
+
+
 def build_prompt(point_dict, last_log):
-    """构造提示词（排除入口/出口）"""
+    """构造用户提示词（排除入口/出口），与 SYSTEM_PREFIX 配合使用"""
     # 只保留任务点（排除 "入口" 和 "出口"）
     task_points = {
         name: p for name, p in point_dict.items()
@@ -152,96 +411,182 @@ def build_prompt(point_dict, last_log):
     # 地图信息
     map_lines = []
     for name, p in task_points.items():
-        task_desc = {0: "无任务", 1: "任务1（扫描）", 2: "任务2（抓取）"}.get(p["arm_task"], "未知")
-        map_lines.append(f"- {name}: ({p['x']:.2f}, {p['y']:.2f}) → {task_desc}")
+        map_lines.append(f"{name},{p['x']:.1f},{p['y']:.1f},{p['arm_task']}")
     map_info = "\n".join(map_lines) or "无任务点"
 
-    # 历史日志
+    # 历史日志（日志行与异常记录一次性拼接）
     log_lines = []
     for pt in last_log.get("visited_points", []):
         status = last_log["tasks_executed"].get(pt, "未记录")
-        log_lines.append(f"- {pt}: {status}")
-    log_info = "\n".join(log_lines) or "无历史记录"
-
+        log_lines.append(f"{pt},{status}")
     anomalies = last_log.get("anomalies", [])
-    if anomalies:
-        log_info += "\n异常记录:\n" + "\n".join(f"  • {a}" for a in anomalies)
+    log_info = "\n".join(chain(
+        log_lines or ["无历史记录"],
+        ["异常记录:"] if anomalies else [],
+        (f"  • {a}" for a in anomalies)
+    ))
+
+    # 仅包含随调用变化的数据；固定规则见 SYSTEM_PREFIX
+    prompt = f"""【地图】
+{map_info}
+【日志】
+{log_info}"""
+    return prompt
 
-    prompt = f"""你是一个智能仓储巡检调度系统。请根据以下信息生成本次巡检计划。
 
-【地图信息】（仅任务点）
-{map_info}
+def plan_max_tokens(point_dict):
+    """按候选任务点数量估算计划 JSON 所需的 max_tokens，避免点多时输出被截断"""
+    n_points = sum(1 for name in point_dict if name not in ("入口", "出口"))
+    return PLAN_BASE_TOKENS + PLAN_TOKENS_PER_POINT * n_points
 
-【历史巡检日志】
-{log_info}
 
-【决策规则】
-1. 必须重试上次失败的点（特别是状态含 'failed' 的）。
-2. 上次成功的点可跳过。
-3. 不要选择 '入口' 或 '出口'（它们仅用于路径起终点）。
-4. 输出必须是严格 JSON，包含：
-   - "decision_reason": 字符串（简要说明）
-   - "inspection_plan": 数组，每项含 "point_name" 和 "action"
-     - action 取值: "arrive", "task_1", "task_2"
+def plan_without_llm(point_dict, last_log):
+    """
+    上次巡检覆盖了全部任务点、无异常且无失败任务时决策是确定的：所有任务点通行一遍。
+    返回与 LLM 输出同结构的计划；历史缺失、不完整或有失败时返回 None（交给 LLM 决策）
+    """
+    task_names = [name for name in point_dict if name not in ("入口", "出口")]
+    statuses = last_log.get("tasks_executed") or {}
+    if not statuses or last_log.get("anomalies"):
+        return None
+    # 中途中止的巡检会缺少部分点的记录，不能视为全部成功
+    for name in task_names:
+        if name not in statuses or "failed" in str(statuses[name]).lower():
+            return None
+    return {
+        "decision_reason": "上次全部成功，走全量通行",
+        "inspection_plan": [{"point_name": name, "action": "arrive"} for name in task_names]
+    }
 
-【重要】
-- 只输出 JSON 内容，不要任何解释、注释、Markdown 或额外文字。
-- 不要包含 ```json 或 ```
 
-- 确保输出可被 Python json.loads() 直接解析。
+def _cache_key(prompt):
+    h = hashlib.blake2b(SYSTEM_PREFIX.encode("utf-8"), digest_size=16)
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
 
-示例输出：
-{{"decision_reason": "货架B区上次抓取失败，需重试。","inspection_plan": [{{"point_name": "货架B区", "action": "task_2"}}]}}
-"""
-    return prompt
+
+def _open_cache():
+    os.makedirs(os.path.dirname(LLM_CACHE_DB), exist_ok=True)
+    conn = sqlite3.connect(LLM_CACHE_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+    return conn
 
 
-def call_llm(prompt):
-    """调用 Qwen3-Max API"""
+def cache_get(prompt):
+    """读取未过期的缓存决策，未命中或缓存不可用返回 None"""
     try:
-        response = Generation.call(
-            api_key=os.getenv("DASHSCOPE_API_KEY"),
-            model="qwen3-max",
-            messages=[{"role": "user", "content": prompt}],
-            result_format="message",
-            temperature=0.0,
-            timeout=15.0
-        )
-        if response.status_code != 200:
-            print(f"❌ Qwen API 错误: {response.code} - {response.message}")
-            return None
+        with closing(_open_cache()) as conn, conn:
+            row = conn.execute(
+                "SELECT value FROM cache WHERE key=? AND expires>?",
+                (_cache_key(prompt), time.time())
+            ).fetchone()
+        return json_loads(row[0]) if row else None
+    except (sqlite3.Error, OSError, json.JSONDecodeError):
+        return None
+
 
-        output_text = response.output.choices[0].message.content
-        json_str = extract_json_from_text(output_text)
-        return json.loads(json_str) if json_str else None
+def cache_put(prompt, plan, ttl=LLM_CACHE_TTL):
+    """写入决策缓存（失败时静默忽略，不影响主流程）"""
+    try:
+        with closing(_open_cache()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                (_cache_key(prompt), json_dumps(plan), time.time() + ttl)
+            )
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def call_llm(prompt, use_cache=True, max_tokens=PLAN_BASE_TOKENS):
+    """调用 Qwen3-Max（优先命中本地缓存；仅缓存成功解析的决策）"""
+    if use_cache:
+        cached = cache_get(prompt)
+        if cached is not None:
+            print("⚡ 命中本地决策缓存")
+            return cached
+
+    plan = request_llm(prompt, max_tokens)
+    if use_cache and plan is not None:
+        cache_put(prompt, plan)
+    return plan
+
+
+def request_llm(prompt, max_tokens=PLAN_BASE_TOKENS):
+    """调用 Qwen3-Max API（SSE 流式输出，首个完整 JSON 对象闭合后不再解析后续事件）"""
+    headers = {
+        "Authorization": f"Bearer {os.getenv('DASHSCOPE_API_KEY')}",
+        "Accept": "text/event-stream",
+        "X-DashScope-SSE": "enable"
+    }
+    body = {
+        "model": "qwen3-max",
+        "input": {
+            "messages": [
+                {"role": "system", "content": SYSTEM_PREFIX},
+                {"role": "user", "content": prompt}
+            ]
+        },
+        "parameters": {
+            "result_format": "message",
+            "temperature": 0.0,
+            "max_tokens": max_tokens,
+            "response_format": {"type": "json_object"},
+            "incremental_output": True
+        }
+    }
+    try:
+        with _HTTP_SESSION.post(GENERATION_URL, headers=headers, json=body, stream=True, timeout=15.0) as resp:
+            if resp.status_code != 200:
+                err = json_loads(resp.content)
+                print(f"❌ Qwen API 错误: {err.get('code')} - {err.get('message')}")
+                return None
+
+            output_text = ""
+            json_closed = False
+            scan = new_json_scan_state()  # 跨 chunk 保留扫描状态，只扫描新追加的文本
+            for line in resp.iter_lines():
+                # JSON 闭合后仅读完剩余事件（JSON 模式下只剩收尾事件），
+                # 响应体读尽后连接才会归还连接池供下次复用
+                if json_closed or not line.startswith(b"data:"):
+                    continue
+                chunk = json_loads(line[5:])
+                if "output" not in chunk:
+                    print(f"❌ Qwen API 错误: {chunk.get('code')} - {chunk.get('message')}")
+                    return None
+                choice = chunk["output"]["choices"][0]
+                scanned = len(output_text)
+                output_text += choice["message"].get("content") or ""
+                json_closed = scan_json_object(output_text, scanned, scan) is not None
+                if not json_closed and choice.get("finish_reason") == "length":
+                    print(f"❌ Qwen 输出达到 max_tokens={max_tokens} 上限被截断，计划不完整")
+                    return None
+
+        # JSON 模式下输出本身即为合法 JSON，提取逻辑仅作兜底
+        try:
+            return json_loads(output_text)
+        except json.JSONDecodeError:
+            json_str = extract_json_from_text(output_text)
+            return json_loads(json_str) if json_str else None
     except Exception as e:
         print(f"❌ 调用失败: {e}")
         return None
 
 
-def enrich_with_coordinates(llm_plan, point_dict):
-    """绑定真实坐标，并过滤出入口"""
+def enrich_with_coordinates(llm_plan, table):
+    """将 LLM 决策绑定到点表下标，并过滤出入口"""
     enriched = []
-    action_map = {
-        "arrive": "arrive",
-        "task_1": "execute_arm_task_1",
-        "task_2": "execute_arm_task_2"
-    }
-
     for item in llm_plan.get("inspection_plan", []):
         name = item.get("point_name")
-        if not name or name not in point_dict:
-            continue
         # 跳过出入口（LLM 不应选，但防御性处理）
-        if name in ["入口", "出口"]:
+        if name in ("入口", "出口"):
+            continue
+        i = table["index"].get(name)
+        if i is None:
             continue
 
-        p = point_dict[name]
         enriched.append({
-            "point_name": name,
-            "position": [round(p["x"], 3), round(p["y"], 3), round(p["z"], 3)],
-            "action": action_map.get(item.get("action"), "unknown"),
-            "arm_task_type": p["arm_task"]
+            "index": i,
+            "action": _ACTION_MAP.get(item.get("action"), "unknown")
         })
     return enriched
 
@@ -251,41 +596,48 @@ def enrich_with_coordinates(llm_plan, point_dict):
 # ======================
 
 def main():
-    print("🔍 正在加载地图与巡检数据...")
-    try:
-        _ = load_map_metadata()  # 验证地图存在
-        point_dict, last_log = load_data()
-    except Exception as e:
-        print(f"🛑 初始化失败: {e}")
-        return
-
-    print("🧠 正在调用 Qwen3-Max 生成巡检决策...")
-    prompt = build_prompt(point_dict, last_log)
-    llm_output = call_llm(prompt)
+    parser = argparse.ArgumentParser(description="智能仓储巡检计划生成器")
+    parser.add_argument("--no-cache", action="store_true", help="忽略本地 LLM 决策缓存，强制调用 API")
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        print("🔍 正在加载地图与巡检数据...")
+        map_fut = ex.submit(load_map_metadata)  # 验证地图存在
+        data_fut = ex.submit(load_data)
+        try:
+            _ = map_fut.result()
+            point_dict, last_log = data_fut.result()
+        except Exception as e:
+            print(f"🛑 初始化失败: {e}")
+            return
+
+        table = build_point_table(point_dict)
+        llm_output = plan_without_llm(point_dict, last_log)
+        if llm_output:
+            print("⚡ 上次巡检全部成功，无需调用 LLM")
+        else:
+            print("🧠 正在调用 Qwen3-Max 生成巡检决策...")
+            prompt = build_prompt(point_dict, last_log)
+            llm_fut = ex.submit(call_llm, prompt, not args.no_cache, plan_max_tokens(point_dict))
+            ex.submit(warm_up_tsp)  # 利用 LLM 网络等待时间完成 JIT 编译
+            llm_output = llm_fut.result()
 
     middle_waypoints = []
     decision_reason = "无任务点，仅通行"
     if llm_output:
         decision_reason = llm_output.get("decision_reason", "无说明")
-        middle_waypoints = enrich_with_coordinates(llm_output, point_dict)
+        middle_waypoints = enrich_with_coordinates(llm_output, table)
         print(f"✅ 决策理由: {decision_reason}")
     else:
         print("⚠️ 无法获取 LLM 决策，仅生成通行路径")
 
     print("🛣️ 正在规划固定起终点的最短路径...")
     try:
-        ordered_waypoints = solve_tsp_with_fixed_ends(middle_waypoints, point_dict)
+        ordered_waypoints, total_dist = solve_tsp_with_fixed_ends(middle_waypoints, table)
     except ValueError as e:
         print(e)
         return
 
-    # 计算总路径长度（米）
-    total_dist = 0.0
-    for i in range(1, len(ordered_waypoints)):
-        p1 = ordered_waypoints[i-1]["position"][:2]
-        p2 = ordered_waypoints[i]["position"][:2]
-        total_dist += euclidean_distance(p1, p2)
-
     # 构建最终输出
     final_plan = {
         "timestamp": "2026-02-14T10:00:00",
@@ -297,7 +649,7 @@ def main():
 
     # 保存到文件
     with open(OUTPUT_PLAN_JSON, "w", encoding="utf-8") as f:
-        json.dump(final_plan, f, ensure_ascii=False, indent=2)
+        f.write(json_dumps(final_plan, indent=True))
 
     print(f"\n🎉 巡检计划已生成 → {OUTPUT_PLAN_JSON}")
     for i, wp in enumerate(ordered_waypoints, 1):